@@ -1,9 +1,9 @@
 import streamlit as st
+import itertools
 import os
+import queue
+import threading
 import time
-import uuid
-from ragflow_sdk import RAGFlow
-from dotenv import load_dotenv, set_key
 
 # 确保 st.set_page_config() 是第一个 Streamlit 命令
 st.set_page_config(
@@ -15,6 +15,10 @@ st.set_page_config(
 
 # 使用 Streamlit UI 库开发一个连接 RAGFlow 的客户端应用，左边列出可选的知识库，右边是聊天对话框。
 
+# 流式输出时的分片合并：累计超过 STREAM_BATCH_CHARS 个字符或距上次产出超过 STREAM_BATCH_INTERVAL 秒才产出
+STREAM_BATCH_CHARS = 64
+STREAM_BATCH_INTERVAL = 0.05
+
 def init_session_state():
     """初始化所有需要的会话状态变量"""
     # API 配置相关
@@ -37,21 +41,37 @@ def init_session_state():
     if "available_datasets" not in st.session_state:
         st.session_state.available_datasets = []
 
+@st.cache_resource(show_spinner=False)
+def get_ragflow_client(api_key, base_url):
+    """按 (api_key, base_url) 缓存 RAGFlow 客户端，避免每次重新运行都重建"""
+    # 延迟导入，首次创建客户端时才加载 ragflow_sdk
+    from ragflow_sdk import RAGFlow
+    
+    return RAGFlow(api_key=api_key, base_url=base_url)
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _list_datasets(api_key, base_url):
+    """缓存知识库列表，避免每次重新运行都请求 RAGFlow"""
+    return get_ragflow_client(api_key, base_url).list_datasets()
+
 def init_ragflow():
     """初始化 RAGFlow 客户端"""
-    # 加载环境变量
-    load_dotenv(override=True)  # 添加 override=True 确保每次都重新加载
-    
-    # 优先使用环境变量，如果不存在则使用会话状态中的值
-    api_key = os.environ.get("RAGFLOW_API_KEY") or st.session_state.get("ragflow_api_key", "")
-    base_url = os.environ.get("RAGFLOW_BASE_URL") or st.session_state.get("ragflow_base_url", "http://localhost:9380")
+    # 每个会话只加载一次环境变量，之后以会话状态为准（配置区的修改会同步写入会话状态）
+    if "env_loaded" not in st.session_state:
+        from dotenv import load_dotenv
+        
+        load_dotenv(override=True)
+        
+        # 优先使用环境变量，如果不存在则使用会话状态中的值
+        st.session_state.ragflow_api_key = os.environ.get("RAGFLOW_API_KEY") or st.session_state.get("ragflow_api_key", "")
+        st.session_state.ragflow_base_url = os.environ.get("RAGFLOW_BASE_URL") or st.session_state.get("ragflow_base_url", "http://localhost:9380")
+        st.session_state.env_loaded = True
     
-    # 更新会话状态
-    st.session_state.ragflow_api_key = api_key
-    st.session_state.ragflow_base_url = base_url
+    api_key = st.session_state.ragflow_api_key
+    base_url = st.session_state.ragflow_base_url
     
     if api_key:
-        return RAGFlow(api_key=api_key, base_url=base_url)
+        return get_ragflow_client(api_key, base_url)
     return None
 
 def create_new_chat():
@@ -78,13 +98,28 @@ def sidebar_content(rag_object):
         
     if rag_object:
         try:
-            datasets = rag_object.list_datasets()
+            datasets = _list_datasets(
+                st.session_state.ragflow_api_key,
+                st.session_state.ragflow_base_url
+            )
             st.session_state.available_datasets = datasets
             
-            selected_datasets = []
-            for dataset in datasets:
-                if st.sidebar.checkbox(f"{dataset.name}", key=f"dataset_{dataset.id}"):
-                    selected_datasets.append(dataset.id)
+            id_to_name = {dataset.id: dataset.name for dataset in datasets}
+            
+            # 去掉已不存在的知识库，避免多选框的值不在可选项中
+            if "dataset_selector" in st.session_state:
+                st.session_state.dataset_selector = [
+                    dataset_id for dataset_id in st.session_state.dataset_selector
+                    if dataset_id in id_to_name
+                ]
+            
+            selected_datasets = st.sidebar.multiselect(
+                "知识库",
+                options=list(id_to_name),
+                format_func=lambda dataset_id: id_to_name[dataset_id],
+                key="dataset_selector",
+                placeholder="请选择知识库"
+            )
             
             st.session_state.selected_datasets = selected_datasets
             
@@ -100,40 +135,54 @@ def sidebar_content(rag_object):
 
     st.sidebar.divider()
 
-    # 使用 expander 创建可折叠的配置区域
+    # 使用 expander 创建可折叠的配置区域，表单提交后统一保存，避免逐个字段写文件和重新运行
     with st.sidebar.expander("⚙️ 配置", expanded=False):
-        # 添加 API Key 配置
-        api_key = st.text_input(
-            "RAGFlow API Key",
-            value=st.session_state.ragflow_api_key,
-            type="password",
-            help="请输入您的 RAGFlow API Key"
-        )
-        if api_key != st.session_state.ragflow_api_key:
-            st.session_state.ragflow_api_key = api_key
-            # 更新环境变量
-            set_key(".env", "RAGFLOW_API_KEY", api_key)
-            st.success("API Key 已更新")
-            st.rerun()
+        with st.form("config"):
+            # 添加 API Key 配置
+            api_key = st.text_input(
+                "RAGFlow API Key",
+                value=st.session_state.ragflow_api_key,
+                type="password",
+                help="请输入您的 RAGFlow API Key"
+            )
+
+            # 添加 Base URL 配置
+            base_url = st.text_input(
+                "RAGFlow Base URL",
+                value=st.session_state.ragflow_base_url,
+                help="RAGFlow 服务器地址"
+            )
+            
+            submitted = st.form_submit_button("保存", use_container_width=True)
+        
+        if submitted:
+            updates = {}
+            if api_key != st.session_state.ragflow_api_key:
+                st.session_state.ragflow_api_key = api_key
+                updates["RAGFLOW_API_KEY"] = api_key
+            if base_url != st.session_state.ragflow_base_url:
+                st.session_state.ragflow_base_url = base_url
+                updates["RAGFLOW_BASE_URL"] = base_url
+            
+            if updates:
+                # 更新环境变量文件，并让客户端和知识库缓存失效
+                from dotenv import set_key
+                
+                for key, value in updates.items():
+                    set_key(".env", key, value)
+                get_ragflow_client.clear()
+                _list_datasets.clear()
+                st.toast("配置已更新", icon="✅")
+                st.rerun()
 
-        # 添加 Base URL 配置
-        base_url = st.text_input(
-            "RAGFlow Base URL",
-            value=st.session_state.ragflow_base_url,
-            help="RAGFlow 服务器地址"
-        )
-        if base_url != st.session_state.ragflow_base_url:
-            st.session_state.ragflow_base_url = base_url
-            # 更新环境变量
-            set_key(".env", "RAGFLOW_BASE_URL", base_url)
-            st.success("Base URL 已更新")
-            st.rerun()
+@st.cache_resource(show_spinner=False)
+def _name_counter():
+    """进程内共享的单调递增计数器，以首次创建时的纳秒时间戳为起点，重新运行脚本时不会重建"""
+    return itertools.count(time.time_ns())
 
 def generate_unique_name(prefix="Chat"):
     """生成唯一的聊天或会话名称"""
-    unique_id = str(uuid.uuid4())[:8]
-    timestamp = int(time.time())
-    return f"{prefix}_{timestamp}_{unique_id}"
+    return f"{prefix}_{next(_name_counter())}"
 
 def format_reference(ref):
     """将不同格式的引用转换为统一的字典格式"""
@@ -148,19 +197,83 @@ def format_reference(ref):
             "document_id": getattr(ref, "document_id", "")
         }
 
+def render_references(references):
+    """将已通过 format_reference 统一格式的引用拼接为一段 markdown"""
+    return "\n\n---\n\n".join(
+        f"**来源文档**: {ref.get('document_name', '未知文档')}\n\n"
+        f"**内容**: {ref.get('content', '无内容')}"
+        for ref in references
+    ) + "\n\n---"
+
+def produce_responses(session, prompt, response_queue, stop_event):
+    """在后台线程中读取 RAGFlow 流式响应并放入队列，结束时放入 None；stop_event 被设置后停止读取"""
+    try:
+        for response in session.ask(prompt, stream=True):
+            if stop_event.is_set():
+                break
+            response_queue.put(response)
+    except Exception as e:
+        response_queue.put(e)
+    finally:
+        response_queue.put(None)
+
+def stream_tokens(session, prompt, state):
+    """逐段产出回答的增量内容，state["response"] 保存最后一个响应对象以便读取引用
+    
+    RAGFlow 响应由后台线程读取，这里按固定节奏从队列中取出并合并后再产出，
+    使网络读取和页面渲染互不阻塞。
+    """
+    response_queue = queue.Queue()
+    stop_event = threading.Event()
+    threading.Thread(
+        target=produce_responses,
+        args=(session, prompt, response_queue, stop_event),
+        daemon=True
+    ).start()
+    
+    # 脚本被中断（新提问、点击按钮等）时生成器会被关闭，此时通知后台线程停止读取
+    try:
+        emitted = ""
+        last_emit_ts = time.monotonic()
+        finished = False
+        while not finished:
+            try:
+                item = response_queue.get(timeout=STREAM_BATCH_INTERVAL)
+                # 每个响应都包含完整的累计内容，只需保留队列中最新的一个
+                while True:
+                    if item is None:
+                        finished = True
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    state["response"] = item
+                    item = response_queue.get_nowait()
+            except queue.Empty:
+                pass
+            
+            response = state["response"]
+            if response is None:
+                continue
+            pending = len(response.content) - len(emitted)
+            if pending > 0 and (finished or pending > STREAM_BATCH_CHARS
+                                or time.monotonic() - last_emit_ts > STREAM_BATCH_INTERVAL):
+                delta = response.content[len(emitted):]
+                emitted = response.content
+                last_emit_ts = time.monotonic()
+                yield delta
+    finally:
+        stop_event.set()
+
 def process_stream_response(session, prompt, message_placeholder):
     """处理流式响应并返回完整响应和引用"""
     try:
-        full_response = ""
-        response = None
+        state = {"response": None}
         
-        # 流式展示回答
-        for response in session.ask(prompt, stream=True):
-            new_content = response.content[len(full_response):]
-            full_response = response.content
-            message_placeholder.markdown(full_response + "▌")
+        # 流式展示回答，由 st.write_stream 负责增量渲染
+        message_placeholder.container().write_stream(stream_tokens(session, prompt, state))
         
-        message_placeholder.markdown(full_response)
+        response = state["response"]
+        full_response = response.content if response else ""
         
         # 处理引用
         references = []
@@ -177,26 +290,22 @@ def main_content(rag_object):
     # 标题
     st.title("RAGFlow 聊天助手")
     
-    # 显示当前会话状态
+    # 显示当前会话状态（预留位置，首次创建聊天后无需重新运行即可填充）
+    caption_placeholder = st.empty()
     if st.session_state.active_chat and st.session_state.active_session:
-        st.caption(f"当前对话：{getattr(st.session_state.active_chat, 'name', '未命名对话')}")
+        caption_placeholder.caption(f"当前对话：{getattr(st.session_state.active_chat, 'name', '未命名对话')}")
     
     # 显示历史消息
     for message in st.session_state.messages:
         with st.chat_message(message["role"]):
             st.markdown(message["content"])
             
-            # 如果消息有引用，显示引用
+            # 如果消息有引用，显示引用（渲染结果缓存在消息中，避免每次重新运行都重新拼接）
             if "reference" in message and message["reference"]:
+                if "_rendered_refs" not in message:
+                    message["_rendered_refs"] = render_references(message["reference"])
                 with st.expander("查看引用来源"):
-                    for ref in message["reference"]:
-                        if isinstance(ref, dict):
-                            st.markdown(f"**来源文档**: {ref.get('document_name', '未知文档')}")
-                            st.markdown(f"**内容**: {ref.get('content', '无内容')}")
-                        else:
-                            st.markdown(f"**来源文档**: {getattr(ref, 'document_name', '未知文档')}")
-                            st.markdown(f"**内容**: {getattr(ref, 'content', '无内容')}")
-                        st.markdown("---")
+                    st.markdown(message["_rendered_refs"])
     
     # 聊天输入
     if prompt := st.chat_input("输入您的问题..."):
@@ -223,6 +332,8 @@ def main_content(rag_object):
                         session_name = generate_unique_name("Session")
                         session = chat.create_session(session_name)
                         st.session_state.active_session = session
+                        
+                        caption_placeholder.caption(f"当前对话：{getattr(chat, 'name', '未命名对话')}")
                     else:
                         session = st.session_state.active_session
                     
@@ -241,16 +352,15 @@ def main_content(rag_object):
                     
                     st.session_state.messages.append(assistant_message)
                     
-                    # 添加重新运行，强制刷新UI以显示最新消息
-                    st.rerun()
+                    # 回答已经流式写入页面，这里直接补上引用，无需重新运行整个脚本
+                    if references:
+                        assistant_message["_rendered_refs"] = render_references(references)
+                        with st.expander("查看引用来源"):
+                            st.markdown(assistant_message["_rendered_refs"])
                     
                 except Exception as e:
-                    error_msg = str(e)
-                    if "Duplicated chat name" in error_msg:
-                        st.error("创建聊天失败：聊天名称重复，请尝试刷新页面")
-                    else:
-                        st.error(f"聊天出错: {error_msg}")
-                        st.error(f"错误详情: {type(e).__name__}")
+                    st.error(f"聊天出错: {str(e)}")
+                    st.error(f"错误详情: {type(e).__name__}")
         else:
             with st.chat_message("assistant"):
                 st.warning("请先选择至少一个知识库，并确保 RAGFlow 连接正常")